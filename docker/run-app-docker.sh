@@ -5,7 +5,6 @@
 
 export PYTHONDONTWRITEBYTECODE=1
 export PYTHONUNBUFFERED=1
-export MAGICK_HOME=/usr
 
 chown -R vrc-embed:vrc-embed /opt/vrc-embed/renders
 
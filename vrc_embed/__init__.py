@@ -1,15 +1,64 @@
 # SPDX-License-Identifier: MIT
 """vrc-embed - Generate SVG/PNG preview of your VRChat profile for embedding on websites."""
 
+import hashlib
+import os
 import os.path
+import pickle
 
 try:
     import tomllib
 except ImportError:
     import toml as tomllib
 
-with open("config.toml", "rb") as config_file:
-    config = tomllib.load(config_file)
+#: Path to the configuration file.
+CONFIG_PATH = "config.toml"
+
+#: Path to the parsed configuration cache.
+CONFIG_CACHE_PATH = CONFIG_PATH + ".cache.pickle"
+
+
+def load_config() -> dict:
+    """
+    Load the configuration file.
+
+    The parsed configuration is cached next to the config file, keyed by the
+    SHA-256 checksum of its contents, so that subsequent worker startups can
+    skip parsing the TOML file.
+    """
+    with open(CONFIG_PATH, "rb") as config_file:
+        data = config_file.read()
+    checksum = hashlib.sha256(data).hexdigest()
+
+    try:
+        with open(CONFIG_CACHE_PATH, "rb") as cache_file:
+            cached_checksum, cached_config = pickle.load(cache_file)
+        if cached_checksum == checksum:
+            return cached_config
+    except Exception:
+        # The cache is optional; if it can't be loaded for any reason (e.g. it
+        # was written by a different version), parse the config file instead
+        pass
+
+    # Parse from memory rather than through the file stream
+    parsed = tomllib.loads(data.decode("utf-8"))
+
+    # Write to temporary file to avoid other workers reading a half-written cache
+    try:
+        tmp_path = f"{CONFIG_CACHE_PATH}.{os.getpid()}"
+        with open(tmp_path, "wb") as cache_file:
+            pickle.dump(
+                (checksum, parsed), cache_file, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(tmp_path, CONFIG_CACHE_PATH)
+    except OSError:
+        pass
+
+    return parsed
+
+
+#: Parsed configuration.
+config = load_config()
 
 
 def get_base_path():
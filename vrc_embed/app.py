@@ -2,7 +2,10 @@
 """Quart app entrypoint."""
 
 import asyncio
-import datetime
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
 
 import timeago
 from quart import Quart, make_response, render_template, request, send_from_directory
@@ -13,10 +16,10 @@ from .button import button_anim, button_static
 from .font import FONTS_PATH, text_width
 from .opts import OptionsManager
 from .render import (
-    RENDERS_PATH,
+    close_session,
     get_render_filename,
     image_cache,
-    render_exists,
+    load_render,
     svg2png,
     svg_inline_images,
 )
@@ -24,7 +27,8 @@ from .vrchat import (
     CACHE_TIMEOUT,
     accept_friend_requests_async,
     api_log_in,
-    get_vrc_user,
+    get_vrc_user_async,
+    vrc_http,
 )
 
 app = Quart(__name__)
@@ -36,9 +40,38 @@ app.jinja_env.globals.update(
 api_log_in()
 
 tasks = QuartTasks(app)
-tasks.add_cron_task(image_cache.prune_dormant, "0 */1 * * *")
 tasks.add_cron_task(accept_friend_requests_async, "* * * * *")
 
+#: Image cache eviction task.
+_image_cache_pruner = None
+
+
+@app.before_serving
+async def start_image_cache_pruner():
+    """Start the image cache eviction worker."""
+    global _image_cache_pruner
+    _image_cache_pruner = asyncio.create_task(image_cache.prune_worker())
+
+
+@app.after_serving
+async def stop_image_cache_pruner():
+    """Stop the image cache eviction worker."""
+    if _image_cache_pruner is not None:
+        _image_cache_pruner.cancel()
+
+
+@app.after_serving
+async def close_vrc_http():
+    """Close the VRChat API HTTP client on shutdown."""
+    await vrc_http.aclose()
+
+
+@app.after_serving
+async def close_image_session():
+    """Close the image download HTTP session on shutdown."""
+    await close_session()
+
+
 #: Valid embed types (templates) and which filetypes they support.
 EMBEDS = {
     "large": ("svg", "png"),
@@ -48,6 +81,20 @@ EMBEDS = {
     "button-static": ("png", "gif"),
 }
 
+#: Mapping of valid "{embed_base_type}.{filetype}" strings to their parts.
+EMBED_BASE = {
+    f"{base}.{filetype}": (base, filetype)
+    for base, filetypes in EMBEDS.items()
+    for filetype in filetypes
+}
+
+#: Compiled SVG templates for each template-based embed type.
+SVG_TEMPLATES = {
+    base: app.jinja_env.get_template(f"image_{base}.svg")
+    for base in EMBEDS
+    if base not in ("button-anim", "button-static")
+}
+
 #: Common configuration options for all embeds.
 #: For an explanation of the type system, see OptionsManager in opts.py.
 COMMON_OPTS = {
@@ -94,28 +141,109 @@ EMBED_OPTS = {
 #: Defaults for all options, passed to the web UI.
 OPT_DEFAULTS = dict((t, EMBED_OPTS[t].get_defaults()) for t in EMBED_OPTS.keys())
 
+#: Rendered index page; it does not change between restarts, so it is rendered
+#: once on startup.
+_index_cached = None
+
+
+@app.before_serving
+async def render_index():
+    """Render the index page once on startup."""
+    global _index_cached
+    _index_cached = await render_template(
+        "index.html",
+        allow_custom_url=not config["general"].get(
+            "block_custom_pfp_and_banner", False
+        ),
+        opt_defaults=OPT_DEFAULTS,
+    )
+
+
+#: Maximum amount of rendered SVGs to keep in the in-process render cache.
+SVG_CACHE_SIZE = 512
+
+#: In-process cache of rendered SVGs, in least-recently-used order.
+_svg_cache = OrderedDict()
+
+
+async def render_svg_cached(
+    embed_base_type: str,
+    user: dict,
+    opts: dict,
+    last_seen_str: Optional[str],
+    etag: str,
+) -> str:
+    """
+    Render the SVG template for the embed, or get it from the render cache.
+
+    The rendered SVG only depends on the user data, options and last seen
+    string, which are all covered by the embed's ETag (see get_embed_etag), so
+    the ETag is used as the cache key; entries for outdated user data fall out
+    of the cache naturally.
+    """
+    key = etag
+
+    svg = _svg_cache.get(key)
+    if svg is not None:
+        _svg_cache.move_to_end(key)
+        return svg
+
+    svg = await SVG_TEMPLATES[embed_base_type].render_async(
+        user=user,
+        last_seen_str=last_seen_str,
+        opts=opts,
+    )
+
+    _svg_cache[key] = svg
+    if len(_svg_cache) > SVG_CACHE_SIZE:
+        _svg_cache.popitem(last=False)
+
+    return svg
+
+
+def get_embed_etag(
+    embed_type: str, user: dict, opts: dict, last_seen_str: Optional[str]
+) -> str:
+    """Get the ETag for an embed with the given parameters."""
+    return hashlib.blake2b(
+        repr(
+            (embed_type, sorted(user.items()), sorted(opts.items()), last_seen_str)
+        ).encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
+
+
+#: Cache-Control header value for embed responses.
+EMBED_CACHE_CONTROL = (
+    f"public, max-age={CACHE_TIMEOUT}, stale-while-revalidate={CACHE_TIMEOUT}"
+)
+
+
+def set_embed_cache_headers(resp, etag: str):
+    """Set the caching headers (ETag and Cache-Control) for an embed response."""
+    resp.set_etag(etag)
+    resp.headers.set("Cache-Control", EMBED_CACHE_CONTROL)
+
 
 @app.route("/<user_id>/<embed_type>")
 async def get_user_embed(user_id: str, embed_type: str):
     """Get embed for the user with the given ID."""
-    embed_base_type = embed_type.split(".")[0]
-    if embed_base_type not in EMBEDS or embed_type not in (
-        embed_base_type + "." + x for x in EMBEDS[embed_base_type]
-    ):
+    parsed = EMBED_BASE.get(embed_type)
+    if parsed is None:
         return {"error": "Invalid embed type"}, 404
-    filetype = embed_type.split(".")[1]
+    embed_base_type, filetype = parsed
 
-    user, user_cached = await asyncio.to_thread(get_vrc_user, user_id)
+    user, _ = await get_vrc_user_async(user_id)
 
     if not user:
         return {"error": "User not found"}, 404
 
     # 88x31 buttons are generated with custom code
     if embed_base_type == "button-anim":
-        return await asyncio.to_thread(button_anim(filetype, user))
+        return await asyncio.to_thread(button_anim, filetype, user)
 
     elif embed_base_type == "button-static":
-        return await asyncio.to_thread(button_static(filetype, user))
+        return await asyncio.to_thread(button_static, filetype, user)
 
     else:
         try:
@@ -136,46 +264,46 @@ async def get_user_embed(user_id: str, embed_type: str):
             }
 
         if opts["lastseen"]:
-            if user.get("last_activity", ""):
+            if user.get("_last_activity_ts") is not None:
+                now = datetime.now(timezone.utc)
                 last_seen_str = timeago.format(
-                    datetime.datetime.fromisoformat(user["last_activity"]).replace(
-                        tzinfo=datetime.timezone.utc
-                    ),
-                    datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc),
+                    datetime.fromtimestamp(user["_last_activity_ts"], tz=timezone.utc),
+                    now,
                 )
             else:
                 last_seen_str = "N/A"
         else:
             last_seen_str = None
 
-        svg = await render_template(
-            f"image_{embed_base_type}.svg",
-            user=user,
-            last_seen_str=last_seen_str,
-            opts=opts,
-        )
+        # If the client already has this exact embed, skip rendering entirely
+        etag = get_embed_etag(embed_type, user, opts, last_seen_str)
+        if request.if_none_match.contains_weak(etag):
+            resp = await make_response("", 304)
+            set_embed_cache_headers(resp, etag)
+            return resp
+
+        svg = await render_svg_cached(embed_base_type, user, opts, last_seen_str, etag)
         if opts["inline_img"]:
             svg = await svg_inline_images(svg.encode("utf-8"))
 
         if filetype == "svg":
             resp = await make_response(svg)
             resp.headers.set("Content-Type", "image/svg+xml")
-            resp.cache_control.max_age = CACHE_TIMEOUT
-            resp.cache_control.public = True
+            set_embed_cache_headers(resp, etag)
             return resp
 
         elif filetype == "png":
             render_filename = get_render_filename(
                 user_id, embed_base_type, opts, filetype
             )
-            if user_cached and await render_exists(render_filename):
-                return await send_from_directory(RENDERS_PATH, render_filename)
-
-            png = await svg2png(bytes(svg, "utf-8"), render_filename)
+            # Renders are only reused if they were made for the same ETag, and
+            # thus from the same user data
+            png = await load_render(render_filename, etag)
+            if png is None:
+                png = await svg2png(bytes(svg, "utf-8"), render_filename, etag)
             resp = await make_response(png)
             resp.headers.set("Content-Type", "image/png")
-            resp.cache_control.max_age = CACHE_TIMEOUT
-            resp.cache_control.public = True
+            set_embed_cache_headers(resp, etag)
             return resp
 
 
@@ -188,16 +316,16 @@ async def favicon():
 @app.route("/")
 async def index():
     """Index page with configurator."""
-    return await render_template(
-        "index.html",
-        allow_custom_url=not config["general"].get(
-            "block_custom_pfp_and_banner", False
-        ),
-        opt_defaults=OPT_DEFAULTS,
+    resp = await make_response(_index_cached)
+    resp.headers.set(
+        "Cache-Control", "public, max-age=3600, stale-while-revalidate=86400"
     )
+    return resp
 
 
 @app.route("/fonts/<font_name>")
 async def font(font_name):
     """Serve a font as a TTF."""
-    return await send_from_directory(FONTS_PATH, font_name)
+    resp = await send_from_directory(FONTS_PATH, font_name)
+    resp.headers.set("Cache-Control", "public, max-age=31536000, immutable")
+    return resp
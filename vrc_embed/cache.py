@@ -1,13 +1,49 @@
 # SPDX-License-Identifier: MIT
 """Cache handling functions and tasks."""
 
-import json
-from typing import Union
+import functools
+import queue
+import threading
+from typing import Iterable, Union
 
 import redis
 
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+
+    def _json_dumps(value) -> bytes:
+        return json.dumps(value).encode("utf-8")
+
+    _json_loads = json.loads
+
 from . import config
 
+#: Maximum amount of queued background writes; when the queue is full, writes
+#: are performed synchronously instead.
+WRITE_QUEUE_SIZE = 10000
+
+#: Maximum amount of background writes sent to Redis in a single pipeline.
+WRITE_BATCH_SIZE = 100
+
+#: Lua script deleting a key only if it still has the given value.
+_DELETE_IF_EQUAL_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+#: Maximum amount of parsed JSON values memoized by their raw value.
+JSON_PARSE_CACHE_SIZE = 2048
+
+#: Memoized JSON parser; returned values are shared between callers.
+_json_loads_shared = functools.lru_cache(maxsize=JSON_PARSE_CACHE_SIZE)(_json_loads)
+
 
 class Cache:
     """Class representing Redis cache."""
@@ -15,64 +51,161 @@ class Cache:
     def __init__(self):
         """Initialize the Cache object."""
 
-        #: Redis configuration.
-        self.cache = redis.Redis(
+        #: Redis connection pool. Blocks for a short while when all connections
+        #: are in use, instead of opening new ones.
+        self.pool = redis.BlockingConnectionPool(
             host=config["redis"]["host"],
             port=config["redis"]["port"],
             password=config["redis"].get("password", None),
-            decode_responses=True,
+            max_connections=config["redis"].get("max_connections", 64),
+            timeout=2,
         )
 
-        #: Redis configuration without decoded responses.
-        self.cache_bin = redis.Redis(
-            host=config["redis"]["host"],
-            port=config["redis"]["port"],
-            password=config["redis"].get("password", None),
-            decode_responses=False,
-        )
-
-    def _set(
-        self, cache: redis.Redis, key: str, value: Union[str, bytes], timeout: int = 0
-    ):
-        cache.set(key, value)
-
+        #: Redis configuration. Responses are not decoded; string values are
+        #: decoded on access instead, so that a single connection pool can be
+        #: used for both strings and bytes.
+        self.cache = redis.Redis(connection_pool=self.pool)
+
+        #: Script for delete_if_equal.
+        self._delete_if_equal = self.cache.register_script(_DELETE_IF_EQUAL_SCRIPT)
+
+        #: Queue of (key, value, timeout) writes for the background writer.
+        self.write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+
+        #: Background writer thread; started on first use.
+        self.write_thread = None
+        self._write_thread_lock = threading.Lock()
+
+    def _write_worker(self):
+        """Send queued writes to Redis in pipelined batches."""
+        while True:
+            batch = [self.write_queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with self.cache.pipeline(transaction=False) as pipe:
+                    for key, value, timeout in batch:
+                        pipe.set(key, value, ex=timeout or None)
+                    pipe.execute()
+            except redis.RedisError as e:
+                print(f"Error writing to cache: {e}")
+
+    def _set(self, key: str, value: Union[str, bytes], timeout: int = 0):
+        # A plain SET clears any existing expiry, so only one round-trip is needed
         if timeout != 0:
-            cache.expire(key, timeout)
+            self.cache.set(key, value, ex=timeout)
         else:
-            cache.persist(key)
+            self.cache.set(key, value)
 
     def get(self, key: str) -> Union[str, None]:
         """Get element by key, as a string."""
-        return self.cache.get(key)
+        value = self.cache.get(key)
+        return value.decode("utf-8") if value is not None else None
 
     def set(self, key: str, value: str, timeout: int = 0):
         """Set the element with the given key to the given string value."""
-        return self._set(self.cache, key, value, timeout)
+        return self._set(key, value, timeout)
+
+    def set_nx(self, key: str, value: Union[str, bytes], timeout: int) -> bool:
+        """
+        Set the element with the given key only if it doesn't exist yet.
+
+        :returns: True if the element was set, False if it already existed.
+        """
+        return bool(self.cache.set(key, value, ex=timeout, nx=True))
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Union[str, None]]:
+        """Get multiple elements by key in a single request, as strings."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        return dict(
+            (key, value.decode("utf-8") if value is not None else None)
+            for key, value in zip(keys, self.cache.mget(keys))
+        )
 
     def get_bin(self, key: str) -> Union[bytes, None]:
         """Get element by key, as bytes."""
-        return self.cache_bin.get(key)
+        return self.cache.get(key)
 
     def set_bin(self, key: str, value: bytes, timeout: int = 0):
         """Set the element with the given key to the given bytes value."""
-        return self._set(self.cache_bin, key, value, timeout)
+        return self._set(key, value, timeout)
 
-    def get_json(self, key: str) -> Union[dict, None]:
-        """Get deserialized JSON value from the cache."""
-        raw = self.get(key)
+    def get_json(self, key: str, shared: bool = False) -> Union[dict, None]:
+        """
+        Get deserialized JSON value from the cache.
+
+        :param shared: If True, identical raw values are only parsed once and the
+            same object is returned for all of them; it must not be modified.
+        """
+        raw = self.get_bin(key)
         if raw is None:
             return None
-        return json.loads(raw)
+        return _json_loads_shared(raw) if shared else _json_loads(raw)
+
+    def get_many_json(
+        self, keys: Iterable[str], shared: bool = False
+    ) -> dict[str, Union[dict, None]]:
+        """
+        Get multiple deserialized JSON values from the cache in a single request.
+
+        :param shared: Same as in get_json.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        loads = _json_loads_shared if shared else _json_loads
+        return dict(
+            (key, loads(raw) if raw is not None else None)
+            for key, raw in zip(keys, self.cache.mget(keys))
+        )
 
     def set_json(self, key: str, value: dict, timeout: int = 0):
         """Set dict serialized to JSON as the cache value for the given key."""
-        serialized = json.dumps(value)
-        return self.set(key, serialized, timeout)
+        serialized = _json_dumps(value)
+        return self.set_bin(key, serialized, timeout)
+
+    def set_json_background(self, key: str, value: dict, timeout: int = 0):
+        """
+        Like set_json, but performs the write in a background thread.
+
+        The value is serialized immediately; the write is not guaranteed to be
+        visible to other readers right after this returns.
+        """
+        serialized = _json_dumps(value)
+
+        if self.write_thread is None:
+            with self._write_thread_lock:
+                if self.write_thread is None:
+                    self.write_thread = threading.Thread(
+                        target=self._write_worker, daemon=True
+                    )
+                    self.write_thread.start()
+
+        try:
+            self.write_queue.put_nowait((key, serialized, timeout))
+        except queue.Full:
+            self.set_bin(key, serialized, timeout)
 
     def delete(self, key: str):
         """Delete element from the cache."""
         self.cache.delete(key)
 
+    def delete_if_equal(self, key: str, value: Union[str, bytes]) -> bool:
+        """
+        Delete element from the cache, only if it still has the given value.
+
+        Useful for releasing locks only if they are still held by the caller.
+
+        :returns: True if the element was deleted, False otherwise.
+        """
+        return bool(self._delete_if_equal(keys=[key], args=[value]))
+
 
 #: Global cache access object.
 cache = Cache()
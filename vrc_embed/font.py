@@ -1,47 +1,46 @@
 # SPDX-License-Identifier: MIT
 """Miscelaneous functions."""
 
+import functools
 import os.path
 
 from PIL import ImageFont
 
 from . import config, get_base_path
 
-#: Loaded font cache for text_width().
-_font_cache = {}
-
 #: Font name to font file mapping.
 FONTS = {"Noto Sans": "notosans.ttf"}
 
 FONTS_PATH = config["general"].get("fonts_path", os.path.join(get_base_path(), "fonts"))
 
 
-def text_width(text: str, font_name: str, size: float) -> float:
+@functools.lru_cache(maxsize=64)
+def _get_font(font_name: str, size: float) -> ImageFont.FreeTypeFont:
     """
-    Get the estimated length in pixels of the given text for the font.
+    Load the font with the given name and size.
 
-    :param text: Text to estimate the length of.
-    :param font_name: Name of the font to use for estimations.
     :raises ValueError: If the font with the given name is not available.
     """
-    global _font_cache
-    font_key = f"{font_name}-{size}"
+    if font_name not in FONTS:
+        raise ValueError(f"Font {font_name} not available")
 
-    if font_key in _font_cache:
-        font = _font_cache[font_key]
-    else:
-        if font_name not in FONTS:
-            raise ValueError(f"Font {font_name} not available")
+    font_path = os.path.join(FONTS_PATH, FONTS[font_name])
 
-        font_path = os.path.join(FONTS_PATH, FONTS[font_name])
+    try:
+        return ImageFont.truetype(font_path, size=size)
+    except OSError as e:
+        raise Exception(
+            f"Missing font file for {font_name}; tried to look in {font_path}"
+        ) from e
 
-        try:
-            font = ImageFont.truetype(font_path, size=size)
-        except OSError as e:
-            raise Exception(
-                f"Missing font file for {font_name}; tried to look in {font_path}"
-            ) from e
 
-        _font_cache[font_key] = font
+@functools.lru_cache(maxsize=4096)
+def text_width(text: str, font_name: str, size: float) -> float:
+    """
+    Get the estimated length in pixels of the given text for the font.
 
-    return font.getlength(text)
+    :param text: Text to estimate the length of.
+    :param font_name: Name of the font to use for estimations.
+    :raises ValueError: If the font with the given name is not available.
+    """
+    return _get_font(font_name, size).getlength(text)
@@ -1,11 +1,208 @@
 # SPDX-License-Identifier: MIT
 """Parser for custom options based on request arguments."""
 
+import copy
 import re
-from typing import Optional
+from typing import Callable, Optional, Union
 
 from werkzeug.datastructures.structures import ImmutableMultiDict
 
+#: Precompiled validators for string-based types.
+_VALIDATORS = {
+    "url": re.compile(r"(?:https?:)?//\S{1,2048}"),
+}
+
+
+#: Type tuples which have already been validated, in their _freeze()d form.
+#: Shared across all OptionsManager instances.
+_valid_type_tuples = set()
+
+
+def _freeze(value: object) -> object:
+    """Convert a type tuple into a hashable form, for use as a cache key."""
+    if isinstance(value, tuple):
+        return tuple(_freeze(v) for v in value)
+    elif isinstance(value, list):
+        return (list, tuple(_freeze(v) for v in value))
+    elif isinstance(value, dict):
+        return (dict, frozenset((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def _check_no_param(ttype: str, tparam: object):
+    """Check type parameter for types which do not accept a parameter."""
+    if tparam is not None:
+        raise ValueError(f"{ttype} type does not accept parameter")
+
+
+def _check_int(ttype: str, tparam: object):
+    """Check type parameter for the int type."""
+    if tparam is None:
+        return
+
+    elif isinstance(tparam, dict):
+        for key in tparam.keys():
+            if key != "min" and key != "max":
+                raise ValueError(f"Invalid key {key} for int type value")
+
+    else:
+        raise ValueError("int parameter must be None or dict")
+
+
+def _check_enum(ttype: str, tparam: object):
+    """Check type parameter for the enum type."""
+    if tparam is None or (
+        not isinstance(tparam, list) and not isinstance(tparam, tuple)
+    ):
+        raise ValueError(
+            "Invalid parameter for enum type; must contain a list or tuple of valid string values"
+        )
+    for val in tparam:
+        if not isinstance(val, str):
+            raise ValueError("enum values must be strings")
+
+
+def _check_list(ttype: str, tparam: object):
+    """Check type parameter for the list type."""
+    try:
+        OptionsManager.type_tuple_is_valid(tparam)
+    except ValueError as e:
+        raise ValueError(f"Invalid type tuple for list: {e}") from e
+
+
+#: Type parameter checks for each type.
+_TYPE_CHECKS = {
+    # str: Basic string parameter.
+    "str": _check_no_param,
+    # int: Basic integer parameter.
+    "int": _check_int,
+    # bool: Boolean parameter; accepts values of "true" or "false".
+    "bool": _check_no_param,
+    # url: URL-encoded URL to a file.
+    "url": _check_no_param,
+    # color: Hex color without # prefix.
+    "color": _check_no_param,
+    # enum: Enumerator of possible string values.
+    "enum": _check_enum,
+    # list: List of values. The type parameter is the type tuple of the values
+    #       within the list.
+    "list": _check_list,
+}
+
+
+def _parser_str(tparam: None) -> Callable[[str], str]:
+    """Get the parser for the str type."""
+    return str
+
+
+def _parser_int(tparam: Optional[dict]) -> Callable[[str], int]:
+    """Get the parser for the int type, with optional min/max bounds."""
+    val_min = tparam.get("min", None) if tparam else None
+    val_max = tparam.get("max", None) if tparam else None
+
+    def _parse_int(value: str) -> int:
+        try:
+            val_int = int(value)
+        except ValueError as e:
+            raise ValueError(f"Invalid integer: {value}") from e
+
+        if val_min is not None and val_int < val_min:
+            raise ValueError(f"Value is lower than minimum ({val_min})")
+
+        if val_max is not None and val_int > val_max:
+            raise ValueError(f"Value is higher than maximum ({val_max})")
+
+        return val_int
+
+    return _parse_int
+
+
+def _parser_bool(tparam: None) -> Callable[[str], bool]:
+    """Get the parser for the bool type."""
+
+    def _parse_bool(value: str) -> bool:
+        if value.lower() == "true":
+            return True
+        elif not value or value.lower() == "false":
+            return False
+        raise ValueError(f"Invalid boolean: {value}")
+
+    return _parse_bool
+
+
+def _parser_url(tparam: None) -> Callable[[str], str]:
+    """Get the parser for the url type."""
+    validator = _VALIDATORS["url"]
+
+    def _parse_url(value: str) -> str:
+        if value and not validator.fullmatch(value):
+            raise ValueError("URL must be a http:// or https:// URL")
+        return value
+
+    return _parse_url
+
+
+def _parser_color(tparam: None) -> Callable[[str], Optional[str]]:
+    """Get the parser for the color type."""
+
+    def _parse_color(value: str) -> Optional[str]:
+        n = len(value)
+        # bytes.fromhex skips whitespace and needs an even amount of
+        # digits, hence the isalnum() check and doubling 3-digit values
+        if (n == 3 or n == 6) and value.isalnum():
+            try:
+                bytes.fromhex(value if n == 6 else value * 2)
+            except ValueError:
+                pass
+            else:
+                if n == 3:
+                    return "#" + value[0] * 2 + value[1] * 2 + value[2] * 2
+                return "#" + value
+        elif not value:
+            return None
+        raise ValueError(
+            "Color value must be hex color without transparency and without # prefix"
+        )
+
+    return _parse_color
+
+
+def _parser_enum(tparam: Union[list, tuple]) -> Callable[[str], str]:
+    """Get the parser for the enum type."""
+    values = frozenset(tparam)
+
+    def _parse_enum(value: str) -> str:
+        if value not in values:
+            raise ValueError(f"Invalid value {value}, must be one of {tparam}")
+        return value
+
+    return _parse_enum
+
+
+def _parser_list(tparam: tuple) -> Callable[[str], list]:
+    """Get the parser for the list type."""
+    parse_item = OptionsManager.parser_from_type_tuple(tparam)
+
+    def _parse_list(value: str) -> list:
+        if not value:
+            return []
+        return [parse_item(x.strip()) for x in value.split(",")]
+
+    return _parse_list
+
+
+#: Parser factories for each type; each takes the type parameter and returns a
+#: function converting a stringified value.
+_PARSERS = {
+    "str": _parser_str,
+    "int": _parser_int,
+    "bool": _parser_bool,
+    "url": _parser_url,
+    "color": _parser_color,
+    "enum": _parser_enum,
+    "list": _parser_list,
+}
+
 
 class OptionsManager:
     """Parser for custom options based on request arguments."""
@@ -17,6 +214,7 @@ class OptionsManager:
 
     def set_options(self, options: dict):
         """Set options from a dictionary contaning options and their type tuples."""
+        parsers = []
         for opt, data in options.items():
             # Validate type tuple
             try:
@@ -24,38 +222,54 @@ class OptionsManager:
             except ValueError as e:
                 raise ValueError(f"Invalid type tuple for {opt}: {e}") from e
 
+            parser = self.parser_from_type_tuple(data["type"])
+
             # Validate default value
+            default = None
             if "default" in data and data["default"] is not None:
                 try:
-                    self.value_from_type_tuple(data["default"], data["type"])
+                    default = parser(data["default"])
                 except ValueError as e:
                     raise ValueError(f"Invalid default value for {opt}: {e}") from e
 
+            # Mutable defaults (lists) are copied for every request, so that
+            # callers can't modify the stored default
+            parsers.append((opt, parser, default, isinstance(default, list)))
+
         self.options = options
 
+        #: Precompiled (option name, parser, parsed default value, whether the
+        #: default value is mutable) tuples.
+        self._parsers = parsers
+
+        #: Names of all known options.
+        self._names = frozenset(options)
+
+        #: Unparsed default values for all options.
+        self._defaults = dict(
+            (opt, data.get("default", None)) for opt, data in options.items()
+        )
+
     def get_defaults(self) -> dict:
         """Get the defaults for all options."""
-        out = {}
-        for opt, data in self.options.items():
-            out[opt] = data.get("default", None)
-        return out
+        return self._defaults.copy()
 
     def parse_args(self, args: ImmutableMultiDict) -> dict:
         """Parse request.args into options."""
-        for arg in args.keys():
-            if arg not in self.options:
-                raise ValueError(f"Unknown option {arg}")
+        unknown = set(args.keys()).difference(self._names)
+        if unknown:
+            # Report the first unknown option in request order
+            arg = next(arg for arg in args.keys() if arg in unknown)
+            raise ValueError(f"Unknown option {arg}")
 
         out = {}
-        for opt, data in self.options.items():
+        for opt, parser, default, mutable in self._parsers:
             value = args.get(opt, None)
             if value is None:
-                value = data.get("default", None)
-                if value is None:
-                    out[opt] = None
-                    continue
+                out[opt] = copy.deepcopy(default) if mutable else default
+                continue
             try:
-                out[opt] = self.value_from_type_tuple(value, data["type"])
+                out[opt] = parser(value)
             except ValueError as e:
                 raise ValueError(f"Invalid value for {opt}: {e}") from e
         return out
@@ -63,6 +277,14 @@ class OptionsManager:
     @classmethod
     def type_tuple_is_valid(cls, tt: tuple) -> bool:
         """Check whether a type tuple is valid. Returns True if so, raises ValueError otherwise."""
+        try:
+            key = _freeze(tt)
+            if key in _valid_type_tuples:
+                return True
+        except TypeError:
+            # Unhashable type parameter; validate without caching
+            key = None
+
         if not isinstance(tt, tuple):
             raise ValueError("Type tuple must be a tuple")
         if len(tt) != 1 and len(tt) != 2:
@@ -70,65 +292,16 @@ class OptionsManager:
         if not isinstance(tt[0], str):
             raise ValueError("First element of type tuple should be a string")
 
-        ttype = tt[0]
-        tparam = tt[1] if len(tt) == 2 else None
+        ttype, tparam = tt if len(tt) == 2 else (tt[0], None)
 
-        # str: Basic string parameter.
-        if ttype == "str":
-            if tparam is not None:
-                raise ValueError("str type does not accept parameter")
-
-        # int: Basic integer parameter.
-        elif ttype == "int":
-            if tparam is None:
-                return True
-
-            elif isinstance(tparam, dict):
-                for key in tparam.keys():
-                    if key != "min" and key != "max":
-                        raise ValueError(f"Invalid key {key} for int type value")
-
-            else:
-                raise ValueError("int parameter must be None or dict")
-
-        #: bool: Boolean parameter; accepts values of "true" or "false".
-        elif ttype == "bool":
-            if tparam is not None:
-                raise ValueError("bool type does not accept parameter")
-
-        # url: URL-encoded URL to a file.
-        elif ttype == "url":
-            if tparam is not None:
-                raise ValueError("url type does not accept parameter")
-
-        # color: Hex color without # prefix.
-        elif ttype == "color":
-            if tparam is not None:
-                raise ValueError("color type does not accept parameter")
-
-        # enum: Enumerator of possible string values.
-        elif ttype == "enum":
-            if tparam is None or (
-                not isinstance(tparam, list) and not isinstance(tparam, tuple)
-            ):
-                raise ValueError(
-                    "Invalid parameter for enum type; must contain a list or tuple of valid string values"
-                )
-            for val in tparam:
-                if not isinstance(val, str):
-                    raise ValueError("enum values must be strings")
-
-        # list: List of values. The type parameter is the type tuple of the values
-        #       within the list.
-        elif ttype == "list":
-            try:
-                cls.type_tuple_is_valid(tparam)
-            except ValueError as e:
-                raise ValueError(f"Invalid type tuple for list: {e}") from e
-
-        else:
-            raise ValueError(f'Unknown type "{ttype}"')
+        try:
+            check = _TYPE_CHECKS[ttype]
+        except KeyError as e:
+            raise ValueError(f'Unknown type "{ttype}"') from e
+        check(ttype, tparam)
 
+        if key is not None:
+            _valid_type_tuples.add(key)
         return True
 
     @classmethod
@@ -138,63 +311,23 @@ class OptionsManager:
 
         The type tuple is already assumed to have been validated.
         """
-
-        ttype = tt[0]
-        tparam = tt[1] if len(tt) == 2 else None
-
         if not isinstance(value, str):
             raise ValueError("Input value must be a string")
 
-        if ttype == "str":
-            return value
-
-        elif ttype == "int":
-            try:
-                val_int = int(value)
-            except ValueError as e:
-                raise ValueError(f"Invalid integer: {value}") from e
-
-            if tparam:
-                if "min" in tparam and val_int < tparam["min"]:
-                    raise ValueError(f"Value is lower than minimum ({tparam['min']})")
+        return cls.parser_from_type_tuple(tt)(value)
 
-                if "max" in tparam and val_int > tparam["max"]:
-                    raise ValueError(f"Value is higher than maximum ({tparam['max']})")
+    @classmethod
+    def parser_from_type_tuple(cls, tt: tuple) -> Callable[[str], object]:
+        """
+        Get a function which converts a stringified value for the type tuple.
 
-            return val_int
+        The returned function raises ValueError if the value is not valid. The
+        type tuple is already assumed to have been validated.
+        """
+        ttype, tparam = tt if len(tt) == 2 else (tt[0], None)
 
-        elif ttype == "bool":
-            if value.lower() == "true":
-                return True
-            elif not value or value.lower() == "false":
-                return False
-            raise ValueError(f"Invalid boolean: {value}")
-
-        elif ttype == "url":
-            return value
-
-        elif ttype == "color":
-            if (
-                value
-                and not re.match("[0-9a-fA-F]{3}", value)
-                and not re.match("[0-9a-fA-F]{6}", value)
-            ):
-                raise ValueError(
-                    "Color value must be hex color without transparency and without # prefix"
-                )
-            if len(value) == 3:
-                return f"#{value[0] * 2}{value[1] * 2}{value[2] * 2}"
-            elif len(value) == 6:
-                return f"#{value}"
-
-        elif ttype == "enum":
-            if value not in tparam:
-                raise ValueError(f"Invalid value {value}, must be one of {tparam}")
-            return value
-
-        elif ttype == "list":
-            if not value:
-                return []
-            return [
-                cls.value_from_type_tuple(x.strip(), tparam) for x in value.split(",")
-            ]
+        try:
+            make_parser = _PARSERS[ttype]
+        except KeyError as e:
+            raise ValueError(f'Unknown type "{ttype}"') from e
+        return make_parser(tparam)
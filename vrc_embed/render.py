@@ -9,17 +9,16 @@ import json
 import os.path
 import tempfile
 import time
-import xml.etree.ElementTree as ET
-from typing import Optional
+from collections import OrderedDict
+from typing import Iterable, Optional
 
 import aiofiles
 import aiofiles.os
 import aiohttp
 import filetype
-import json_fingerprint
+import pyvips
 from filetype.types import IMAGE as image_matchers
-from wand.color import Color
-from wand.image import Image
+from lxml import etree
 
 try:
     from asyncio import TaskGroup
@@ -33,6 +32,65 @@ RENDERS_PATH = config["general"].get(
     "renders_path", os.path.join(get_base_path(), "renders")
 )
 
+#: Time after which an unused image is removed from the image cache, in seconds.
+IMAGE_CACHE_DORMANT_TIME = 60 * 60 * 12
+
+#: Amount of images in the image cache above which eviction is started early.
+IMAGE_CACHE_MAX_ENTRIES = 1024
+
+#: Access counter value at which all image cache access counters are halved.
+IMAGE_CACHE_COUNTER_MAX = 255
+
+#: Maximum time between two image cache eviction passes, in seconds.
+IMAGE_CACHE_PRUNE_INTERVAL = 60
+
+#: Amount of files removed by the image cache eviction pass before yielding
+#: back to the event loop.
+IMAGE_CACHE_PRUNE_CHUNK = 32
+
+
+#: Shared HTTP session for downloading images; created on first use, so that it
+#: is bound to the running event loop.
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Get the shared HTTP session used for downloading images."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            headers={
+                "User-Agent": "vrc-embed/0.0.1 (https://github.com/knuxify/vrc-embed)"
+            }
+        )
+    return _session
+
+
+async def close_session():
+    """Close the shared HTTP session used for downloading images."""
+    if _session is not None:
+        await _session.close()
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_file_atomic(path: str, data: bytes):
+    # Write to temporary file to avoid serving half-finished files; the name is
+    # unique so that concurrent writes to the same path don't mix
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path),
+        prefix="." + os.path.basename(path) + ".",
+        delete=False,
+    ) as f:
+        f.write(data)
+        tmp_path = f.name
+
+    # Move temporary file to main location
+    os.replace(tmp_path, path)
+
 
 class ImageCache:
     """Image file cache manager."""
@@ -42,11 +100,19 @@ class ImageCache:
         self.tmpdir = tempfile.TemporaryDirectory()
         self.path = self.tmpdir.name
 
-        #: Last cache hit for each stored image.
-        self.last_hit = {}
+        #: Last cache hit for each stored image, from least to most recent.
+        self.last_hit = OrderedDict()
+
+        #: Access counter for each stored image, used to pick which images to
+        #: evict when the cache grows too large.
+        self.hit_count = {}
 
-        #: List of files which are currently being downloaded.
-        self.download_queue = set()
+        #: Event used to wake up the eviction worker early.
+        self.prune_event = None
+
+        #: URLs which are currently being downloaded, mapped to an event which is
+        #: set once the download finishes.
+        self.in_flight = {}
 
     def close_tmpdir(self):
         """
@@ -56,54 +122,116 @@ class ImageCache:
         """
         self.tmpdir.cleanup()
         del self.last_hit
+        del self.hit_count
 
     async def get(self, url: str) -> bytes:
         """Download an image or fetch it from the cache."""
-        url_hash = await asyncio.to_thread(
-            lambda url: hashlib.sha512(url.encode("utf-8")).hexdigest(), url
-        )
+        url_hash = hashlib.blake2b(url.encode("utf-8"), digest_size=32).hexdigest()
         self.last_hit[url_hash] = time.time()
+        self.last_hit.move_to_end(url_hash)
+        self.count_hit(url_hash)
 
         path = os.path.join(self.path, url_hash)
 
-        # If the URL is currently being downloaded, wait until that download finishes
-        while url in self.download_queue:
-            await asyncio.sleep(0.05)
-        self.download_queue.add(url)
+        while True:
+            # If the URL is currently being downloaded, wait until that download
+            # finishes
+            event = self.in_flight.get(url)
+            if event is not None:
+                await event.wait()
 
-        # If we have a cached file, serve it
-        if await aiofiles.os.path.exists(path):
-            self.download_queue.remove(url)
-            async with aiofiles.open(path, "rb") as f:
-                return await f.read()
-
-        # Otherwise, download the image file and save it to the cache
-        else:
-            ret = bytes()
-            headers = {
-                "User-Agent": "vrc-embed/0.0.1 (https://github.com/knuxify/vrc-embed)"
-            }
+            # If we have a cached file, serve it
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers) as response:
-                        async with aiofiles.open(path, "wb") as f:
-                            async for chunk in response.content.iter_chunked(4096):
-                                await f.write(chunk)
-                                ret += chunk
-            except:  # noqa: E722
-                ret = None
+                return await asyncio.to_thread(_read_file, path)
+            except FileNotFoundError:
+                # Another download may have started while we were checking
+                if url not in self.in_flight:
+                    break
 
-            self.download_queue.remove(url)
-
-            return ret
+        # Otherwise, download the image file and save it to the cache
+        event = asyncio.Event()
+        self.in_flight[url] = event
+        try:
+            session = await get_session()
+            async with session.get(url) as response:
+                ret = await response.read()
+            await asyncio.to_thread(_write_file_atomic, path, ret)
+        except:  # noqa: E722
+            ret = None
+        finally:
+            del self.in_flight[url]
+            event.set()
+
+        return ret
+
+    def count_hit(self, url_hash: str):
+        """Increment the access counter for the image with the given hash."""
+        count = self.hit_count.get(url_hash, 0) + 1
+        self.hit_count[url_hash] = count
+
+        # Halve all counters once one saturates, so that old popularity decays
+        if count >= IMAGE_CACHE_COUNTER_MAX:
+            for key, value in self.hit_count.items():
+                self.hit_count[key] = value // 2
+
+        if len(self.last_hit) > IMAGE_CACHE_MAX_ENTRIES and self.prune_event:
+            self.prune_event.set()
+
+    async def prune(self):
+        """
+        Evict images from the cache.
 
-    async def prune_dormant(self):
-        """Prune unused images that haven't been used in a while."""
+        Images that haven't been used in a while are always removed; if the cache
+        is still too large afterwards, the least used images are removed as well.
+        """
         now = time.time()
-        for url_hash, last_hit in list(self.last_hit.items()).copy():
-            if (now - last_hit) > (60 * 60 * 12):
-                del self.last_hit[url_hash]
-                await aiofiles.os.remove(os.path.join(self.path, url_hash))
+        to_remove = []
+        # last_hit is ordered by recency, so stop at the first non-dormant image
+        for url_hash, last_hit in self.last_hit.items():
+            if (now - last_hit) <= IMAGE_CACHE_DORMANT_TIME:
+                break
+            to_remove.append(url_hash)
+
+        excess = len(self.last_hit) - len(to_remove) - IMAGE_CACHE_MAX_ENTRIES
+        if excess > 0:
+            dormant = set(to_remove)
+            by_score = sorted(
+                (h for h in self.last_hit if h not in dormant),
+                key=lambda h: (self.hit_count.get(h, 0), self.last_hit[h]),
+            )
+            to_remove += by_score[:excess]
+
+        for url_hash in to_remove:
+            self.last_hit.pop(url_hash, None)
+            self.hit_count.pop(url_hash, None)
+
+        # Remove files in parallel, in chunks
+        for i in range(0, len(to_remove), IMAGE_CACHE_PRUNE_CHUNK):
+            await asyncio.gather(
+                *(
+                    aiofiles.os.remove(os.path.join(self.path, url_hash))
+                    for url_hash in to_remove[i : i + IMAGE_CACHE_PRUNE_CHUNK]
+                ),
+                return_exceptions=True,
+            )
+
+    async def prune_worker(self):
+        """
+        Run the image cache eviction loop.
+
+        Eviction runs every IMAGE_CACHE_PRUNE_INTERVAL seconds, or as soon as
+        the cache grows past IMAGE_CACHE_MAX_ENTRIES.
+        """
+        self.prune_event = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.prune_event.wait(), IMAGE_CACHE_PRUNE_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+            self.prune_event.clear()
+            await self.prune()
 
 
 #: Image cache handler.
@@ -120,29 +248,69 @@ def get_render_filename(
     Note that this only contains the filename, not the renders directory.
     """
     if opts:
-        fp = json_fingerprint.create(
-            json.dumps(opts), json_fingerprint.hash_functions.SHA256, 1
-        ).split("$")[2]
+        fp = hashlib.blake2b(
+            json.dumps(opts, sort_keys=True, separators=(",", ":")).encode("utf-8"),
+            digest_size=16,
+        ).hexdigest()
         return user_id + "." + embed_base_type + "." + fp + "." + filetype
     return user_id + "." + embed_base_type + "." + filetype
 
 
-async def save_render(filename: str, data: bytes):
-    """Save a rendered image to the renders directory with the given filename."""
-
-    # Write to temporary file to avoid serving half-finished render
-    async with aiofiles.open(os.path.join(RENDERS_PATH, "." + filename), "wb") as f:
-        await f.write(data)
+async def save_render(filename: str, data: bytes, etag: str):
+    """
+    Save a rendered image to the renders directory with the given filename.
 
-    # Move temporary file to main location
-    await aiofiles.os.replace(
-        os.path.join(RENDERS_PATH, "." + filename), os.path.join(RENDERS_PATH, filename)
+    The ETag of the embed the image was rendered for is stored in front of the
+    image data, so that the render is only reused for the same embed.
+    """
+    await asyncio.to_thread(
+        _write_file_atomic,
+        os.path.join(RENDERS_PATH, filename),
+        etag.encode("ascii") + b"\n" + data,
     )
 
 
+async def load_render(filename: str, etag: str) -> Optional[bytes]:
+    """
+    Load a rendered image saved with save_render.
+
+    :returns: Image data if the render exists and was saved with the given ETag,
+        None otherwise.
+    """
+    try:
+        data = await asyncio.to_thread(_read_file, os.path.join(RENDERS_PATH, filename))
+    except FileNotFoundError:
+        return None
+
+    header = etag.encode("ascii") + b"\n"
+    if not data.startswith(header):
+        return None
+    return data[len(header) :]
+
+
 async def render_exists(filename: str) -> bool:
     """Check if the render with the given filename exists."""
-    return await aiofiles.os.path.exists(os.path.join(RENDERS_PATH, filename))
+    return await asyncio.to_thread(os.path.exists, os.path.join(RENDERS_PATH, filename))
+
+
+async def render_exists_many(filenames: Iterable[str]) -> dict[str, bool]:
+    """Check if the renders with the given filenames exist, in a single thread hop."""
+
+    def _check():
+        return dict(
+            (filename, os.path.exists(os.path.join(RENDERS_PATH, filename)))
+            for filename in filenames
+        )
+
+    return await asyncio.to_thread(_check)
+
+
+#: Byte strings, one of which is present in any SVG with remote image links.
+_REMOTE_HREF_MARKERS = (b'href="http', b'href="//', b"href='http", b"href='//")
+
+#: XML parser for SVGs; skips building the ID lookup table, which is not needed
+#: for inlining images.
+_svg_parser = etree.XMLParser(collect_ids=False)
 
 
 async def svg_inline_images(source: bytes) -> bytes:
@@ -152,21 +320,19 @@ async def svg_inline_images(source: bytes) -> bytes:
     Most SVG renderers cannot fetch external images themselves; as such,
     we need to perform the inlining here.
     """
-    ET.register_namespace("", "http://www.w3.org/2000/svg")
-    source_str = source.decode("utf-8")
-    source_el = ET.fromstring(source_str)
+    # Skip parsing the SVG if it can't contain any remote images
+    if b"<image" not in source or not any(
+        marker in source for marker in _REMOTE_HREF_MARKERS
+    ):
+        return source
+
+    source_el = etree.fromstring(source, _svg_parser)
 
     # Find all <image> tags and check if they have valid href values
     images = []
-    for img in source_el.iter():
-        if not img.tag.endswith("image"):
-            continue
-
-        if "href" in img.attrib and (
-            img.attrib["href"].startswith("https://")
-            or img.attrib["href"].startswith("http://")
-            or img.attrib["href"].startswith("//")
-        ):
+    for img in source_el.iter("{http://www.w3.org/2000/svg}image"):
+        href = img.attrib.get("href")
+        if href is not None and href.startswith(("https://", "http://", "//")):
             images.append(img)
 
     # If there are no valid tags, we have nothing to do
@@ -178,8 +344,7 @@ async def svg_inline_images(source: bytes) -> bytes:
         data = await image_cache.get(img.attrib["href"])
 
         # Base64-encode the image data and replace href attribute
-        b64 = await asyncio.to_thread(base64.b64encode, data)
-        b64_str = await asyncio.to_thread(b64.decode, "ascii")
+        b64_str = base64.b64encode(data).decode("ascii")
         mimetype = filetype.match(data, matchers=image_matchers)
         if mimetype:
             img.attrib["href"] = f"data:{mimetype.mime};base64," + b64_str
@@ -194,33 +359,34 @@ async def svg_inline_images(source: bytes) -> bytes:
             _tasks.add(tg.create_task(_inline_image(img)))
 
     # Turn the modified element tree back into bytes and return the result
-    return ET.tostring(source_el, encoding="utf-8")
+    return etree.tostring(source_el, encoding="utf-8")
 
 
-def _wand_svg2png(source: bytes) -> bytes:
-    with Image() as img:
-        img.background_color = Color("transparent")
-        img.read(blob=source, format="svg", depth=8)
-        img.options["png:compression-level"] = "9"
-        return img.make_blob("png")
+def _vips_svg2png(source: bytes) -> bytes:
+    img = pyvips.Image.new_from_buffer(source, "")
+    # Compression level 6 is within a few percent of 9 in size, but much faster;
+    # metadata chunks are not needed for embeds
+    return img.pngsave_buffer(compression=6, strip=True)
 
 
-async def svg2png(source: bytes, filename: Optional[str] = None) -> bytes:
+async def svg2png(
+    source: bytes, filename: Optional[str] = None, etag: Optional[str] = None
+) -> bytes:
     """
     Convert an SVG file (provided as bytes) to a PNG (returned as bytes).
 
-    With the write_path parameter, will also create a background task to write
-    the file.
+    With the filename and etag parameters, will also create a background task to
+    write the file with save_render.
     """
 
     # Get the SVG with all images inlined
     source = await svg_inline_images(source)
 
-    # Send a call to wand/ImageMagick to process the image
-    out = await asyncio.to_thread(_wand_svg2png, source)
+    # Send a call to libvips to process the image
+    out = await asyncio.to_thread(_vips_svg2png, source)
 
     # Start a task to save the resulting render in the background
     if filename is not None:
-        asyncio.create_task(save_render(filename, out))
+        asyncio.create_task(save_render(filename, out, etag or ""))
 
     return out
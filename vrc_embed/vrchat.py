@@ -2,11 +2,21 @@
 """Fetching data from VRChat and caching."""
 
 import asyncio
+import hashlib
+import hmac
 import json
-import pickle
+import operator
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from http.cookiejar import Cookie
-from typing import Tuple, Union
+from types import MappingProxyType
+from typing import Iterable, Optional, Tuple, Union
+from urllib.parse import quote
 
+import httpx
 import pyotp
 import vrchatapi
 from vrchatapi.api import authentication_api, notifications_api, users_api
@@ -14,6 +24,7 @@ from vrchatapi.exceptions import NotFoundException, UnauthorizedException
 from vrchatapi.models.notification_type import NotificationType
 from vrchatapi.models.two_factor_auth_code import TwoFactorAuthCode
 from vrchatapi.models.two_factor_email_code import TwoFactorEmailCode
+from vrchatapi.models.user import User
 
 from . import config
 from .cache import cache
@@ -25,11 +36,75 @@ VRC_CONFIG = vrchatapi.Configuration(
 vrc_api = vrchatapi.ApiClient(VRC_CONFIG)
 vrc_api.user_agent = "vrc-embed/0.0.1 (https://github.com/knuxify/vrc-embed)"
 
+#: Users API client; shares the login cookies of vrc_api.
+user_api = users_api.UsersApi(vrc_api)
+
+#: Async HTTP client for VRChat API requests made from the event loop. Shares
+#: the login cookies of vrc_api.
+vrc_http = httpx.AsyncClient(
+    base_url=VRC_CONFIG.host,
+    headers={"User-Agent": vrc_api.user_agent},
+    http2=True,
+    timeout=10,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=8),
+)
+
 LOGGED_IN = False
 
 #: Cache timeout, in seconds.
 CACHE_TIMEOUT: int = config["vrchat"].get("cache_timeout", 60)
 
+#: How long user data is kept in the cache after it goes stale, in seconds.
+#: During this time, stale data is served while it is refreshed in the background.
+USER_STALE_TIMEOUT: int = CACHE_TIMEOUT * 10
+
+#: How long to remember that a user does not exist, in seconds.
+USER_NOT_FOUND_TIMEOUT: int = config["vrchat"].get("not_found_cache_timeout", 600)
+
+#: How long user cache entries are kept in the in-process cache, in seconds.
+LOCAL_CACHE_TIMEOUT: int = 10
+
+#: Maximum amount of user cache entries kept in the in-process cache.
+LOCAL_CACHE_SIZE: int = 1024
+
+#: How long the lock preventing concurrent API requests for the same user is
+#: held, in seconds. The lock is released by expiring.
+USER_FETCH_LOCK_TIMEOUT: int = 10
+
+#: How long to wait for another request to fetch a user before fetching it
+#: anyway, in seconds.
+USER_FETCH_WAIT_TIMEOUT: float = 5
+
+#: How often to check whether another request has fetched a user, in seconds.
+USER_FETCH_POLL_INTERVAL: float = 0.1
+
+#: Key used to sign the login cookies saved in the cache.
+COOKIE_SECRET: bytes = hashlib.sha256(
+    config["vrchat"]
+    .get("cookie_secret", "vrc-embed cookies:" + config["vrchat"]["password"])
+    .encode("utf-8")
+).digest()
+
+#: Key of the lock preventing multiple workers from logging in at once.
+LOGIN_LOCK_KEY = "vrcembed:lock:login"
+
+#: How long the login lock is held at most, in seconds.
+LOGIN_LOCK_TIMEOUT: int = 30
+
+#: How long to wait for another worker to log in before reusing its login
+#: cookies, in seconds.
+LOGIN_LOCK_WAIT: float = 1
+
+#: Maximum amount of users fetched from the API in parallel by get_vrc_users.
+USER_FETCH_WORKERS: int = 8
+
+#: Thread pool used by get_vrc_users to fetch users from the API.
+_user_fetch_executor = ThreadPoolExecutor(max_workers=USER_FETCH_WORKERS)
+
+#: In-process cache in front of Redis, mapping user IDs to (time stored, cache
+#: entry) tuples in least-recently-stored order.
+_local_users = OrderedDict()
+
 #: Properties to include in the cache for VRChat users. All properties used in
 #: the templates should be included in this list.
 USER_CACHED_PROPERTIES = (
@@ -45,43 +120,133 @@ USER_CACHED_PROPERTIES = (
     "status_description",
 )
 
+#: Getter for all properties in USER_CACHED_PROPERTIES, in one call.
+_user_getter = operator.attrgetter(*USER_CACHED_PROPERTIES)
+
+#: Pairs of USER_CACHED_PROPERTIES and their names in raw API JSON responses.
+_user_json_keys = tuple((k, User.attribute_map[k]) for k in USER_CACHED_PROPERTIES)
+
 
-def api_make_cookie(name: str, value: str) -> Cookie:
+def api_make_cookie(
+    name: str,
+    value: str,
+    domain: str = "api.vrchat.cloud",
+    path: str = "/",
+    expires: Optional[int] = None,
+    secure: bool = False,
+) -> Cookie:
     """Create a Cookie object for the cookie with the given name and value."""
     return Cookie(
         version=0,
         name=name,
         value=value,
+        port=None,
+        port_specified=False,
+        domain=domain,
+        domain_specified=domain.startswith("."),
+        domain_initial_dot=domain.startswith("."),
+        path=path,
+        path_specified=True,
+        secure=secure,
+        expires=expires,
+        discard=False,
+        comment=None,
+        comment_url=None,
+        rest={},
     )
 
 
+def _sign_cookie_data(data: bytes) -> bytes:
+    """Get the HMAC signature for serialized cookie data, as a hex string."""
+    return hmac.new(COOKIE_SECRET, data, hashlib.sha256).hexdigest().encode("ascii")
+
+
+def cookie_to_json(cookie: Cookie) -> bytes:
+    """
+    Serialize the fields of a cookie needed to recreate it into JSON.
+
+    The JSON is prefixed with its signature and a colon.
+    """
+    data = json.dumps(
+        {
+            "name": cookie.name,
+            "value": cookie.value,
+            "domain": cookie.domain,
+            "path": cookie.path,
+            "expires": cookie.expires,
+            "secure": cookie.secure,
+        }
+    ).encode("utf-8")
+    return _sign_cookie_data(data) + b":" + data
+
+
+def cookie_from_json(data: bytes) -> Cookie:
+    """
+    Recreate a cookie serialized with cookie_to_json.
+
+    :raises ValueError: If the signature is missing or does not match.
+    """
+    signature, _, data = data.partition(b":")
+    if not hmac.compare_digest(signature, _sign_cookie_data(data)):
+        raise ValueError("Invalid cookie signature")
+    return api_make_cookie(**json.loads(data))
+
+
+def api_load_cookies() -> bool:
+    """
+    Load the login cookies saved in the cache into the API client.
+
+    :returns: True if the cookies were loaded, False otherwise.
+    """
+    auth_cookie_cached = cache.get_bin("vrcembed:cookies:auth")
+    twofactorauth_cookie_cached = cache.get_bin("vrcembed:cookies:twofactorauth")
+
+    # Either cookie may have been evicted from the cache on its own
+    if not auth_cookie_cached or not twofactorauth_cookie_cached:
+        return False
+
+    try:
+        auth_cookie = cookie_from_json(auth_cookie_cached)
+        assert auth_cookie.name == "auth"
+        twofactorauth_cookie = cookie_from_json(twofactorauth_cookie_cached)
+        assert twofactorauth_cookie.name == "twoFactorAuth"
+    except (AttributeError, AssertionError, TypeError, ValueError):
+        return False
+
+    vrc_api.rest_client.cookie_jar.set_cookie(auth_cookie)
+    vrc_api.rest_client.cookie_jar.set_cookie(twofactorauth_cookie)
+    return True
+
+
 def api_log_in(force_no_cookies: bool = False) -> bool:
     """
     Log into the VRChat API using the credentials.
 
+    Only one worker logs in at a time; if another worker is already logging
+    in, this waits for LOGIN_LOCK_WAIT seconds and reuses its login cookies.
+
     :param force_no_cookies: If True, ignores the existing login cookies.
     :returns: True if logging in succeeded, False otherwise.
     """
-    auth_api = authentication_api.AuthenticationApi(vrc_api)
+    # The lock holds a random token, so that a login that outlives the lock
+    # (e.g. waiting for 2FA input) doesn't release a lock another worker took
+    token = secrets.token_hex(16)
+    if not cache.set_nx(LOGIN_LOCK_KEY, token, timeout=LOGIN_LOCK_TIMEOUT):
+        time.sleep(LOGIN_LOCK_WAIT)
+        return api_load_cookies()
 
-    if force_no_cookies:
-        auth_cookie_cached = None
-        twofactorauth_cookie_cached = None
-    else:
-        auth_cookie_cached = cache.get_bin("vrcembed:cookies:auth")
-        twofactorauth_cookie_cached = cache.get_bin("vrcembed:cookies:twofactorauth")
+    try:
+        return _api_log_in(force_no_cookies)
+    finally:
+        cache.delete_if_equal(LOGIN_LOCK_KEY, token)
 
-    if auth_cookie_cached:
-        try:
-            auth_cookie = pickle.loads(auth_cookie_cached)
-            assert auth_cookie.name == "auth"
-            twofactorauth_cookie = pickle.loads(twofactorauth_cookie_cached)
-            assert twofactorauth_cookie.name == "twoFactorAuth"
-        except (AttributeError, AssertionError, pickle.UnpicklingError):
-            pass
-        else:
-            vrc_api.rest_client.cookie_jar.set_cookie(auth_cookie)
-            vrc_api.rest_client.cookie_jar.set_cookie(twofactorauth_cookie)
+
+def _api_log_in(force_no_cookies: bool = False) -> bool:
+    """Log into the VRChat API; see api_log_in."""
+    auth_api = authentication_api.AuthenticationApi(vrc_api)
+
+    if not force_no_cookies:
+        api_load_cookies()
 
     try:
         current_user = auth_api.get_current_user()
@@ -162,9 +327,9 @@ def api_log_in(force_no_cookies: bool = False) -> bool:
 
     # Save login cookie for subsequent runs.
     cookie_jar = vrc_api.rest_client.cookie_jar._cookies["api.vrchat.cloud"]["/"]
-    cache.set_bin("vrcembed:cookies:auth", pickle.dumps(cookie_jar["auth"]))
+    cache.set_bin("vrcembed:cookies:auth", cookie_to_json(cookie_jar["auth"]))
     cache.set_bin(
-        "vrcembed:cookies:twofactorauth", pickle.dumps(cookie_jar["twoFactorAuth"])
+        "vrcembed:cookies:twofactorauth", cookie_to_json(cookie_jar["twoFactorAuth"])
     )
 
     return True
@@ -172,48 +337,364 @@ def api_log_in(force_no_cookies: bool = False) -> bool:
 
 def serialize_user(user: vrchatapi.models.user.User) -> dict:
     """Serialize user data into a dictionary."""
-    out = dict((k, (getattr(user, k) or "")) for k in USER_CACHED_PROPERTIES)
+    out = dict(
+        (k, (v or "")) for k, v in zip(USER_CACHED_PROPERTIES, _user_getter(user))
+    )
+    return _serialize_user_extra(out)
+
+
+def serialize_user_json(data: dict) -> dict:
+    """Serialize user data from a raw API JSON response into a dictionary."""
+    out = dict((k, (data.get(json_key) or "")) for k, json_key in _user_json_keys)
+    return _serialize_user_extra(out)
 
+
+def _serialize_user_extra(out: dict) -> dict:
+    """Add derived fields to serialized user data."""
     # Manually add the user icon thumbnail field
     if out["user_icon"]:
         out["user_icon_thumbnail"] = (
-            out["user_icon"].replace("/api/1/file", "/api/1/image") + "/128"
+            out["user_icon"].replace("/api/1/file", "/api/1/image", 1) + "/128"
         )
 
+    # Pre-parse the last activity timestamp so that it doesn't have to be parsed
+    # again on every cache hit
+    if out["last_activity"]:
+        last_activity = datetime.fromisoformat(out["last_activity"])
+        if last_activity.tzinfo is None:
+            last_activity = last_activity.replace(tzinfo=timezone.utc)
+        out["_last_activity_ts"] = last_activity.timestamp()
+    else:
+        out["_last_activity_ts"] = None
+
     return out
 
 
-def get_vrc_user(user_id: str) -> Tuple[Union[dict, None], bool]:
+def get_user_cache_key(user_id: str) -> str:
     """
-    Fetch information about a VRChat user by their user ID.
+    Get the cache key for the VRChat user with the given ID.
+
+    The user ID is used as a Redis Cluster hash tag, so that all keys for a
+    user land in the same slot.
+    """
+    return f"vrcembed:users:{{{user_id}}}"
+
+
+def _local_get(user_id: str) -> Union[dict, None]:
+    """Get a user cache entry from the in-process cache."""
+    item = _local_users.get(user_id)
+    if item is None:
+        return None
+    if (time.monotonic() - item[0]) >= LOCAL_CACHE_TIMEOUT:
+        _local_users.pop(user_id, None)
+        return None
+    return item[1]
+
+
+def _local_set(user_id: str, entry: dict):
+    """Store a user cache entry in the in-process cache."""
+    _local_users[user_id] = (time.monotonic(), entry)
+    _local_users.move_to_end(user_id)
+    if len(_local_users) > LOCAL_CACHE_SIZE:
+        _local_users.popitem(last=False)
+
+
+def cache_user(user_id: str, user: dict):
+    """Store user data in the cache, along with the time it was fetched at."""
+    entry = {"t": int(time.time()), "u": user}
+    cache.set_json_background(
+        get_user_cache_key(user_id),
+        entry,
+        timeout=CACHE_TIMEOUT + USER_STALE_TIMEOUT,
+    )
+    _local_set(user_id, entry)
+
+
+def cache_user_not_found(user_id: str):
+    """Remember in the cache that the user with the given ID does not exist."""
+    entry = {"__nf__": 1}
+    cache.set_json_background(
+        get_user_cache_key(user_id), entry, timeout=USER_NOT_FOUND_TIMEOUT
+    )
+    _local_set(user_id, entry)
+
+
+def _unpack_cached_user(
+    entry: Union[dict, None], now: Optional[float] = None
+) -> Tuple[Union[dict, None], bool]:
+    """
+    Get the user data and staleness from a cache entry.
+
+    Cache entries are shared between requests (see Cache.get_json), so user
+    data is wrapped in a read-only MappingProxyType. Users cached as not found
+    are returned as an empty dictionary.
+
+    :param now: Current time, to avoid looking it up again when unpacking
+        multiple entries.
+    """
+    if entry and entry.get("__nf__"):
+        return ({}, False)
+    if not entry or not entry.get("u"):
+        return (None, False)
+    if now is None:
+        now = time.time()
+    return (MappingProxyType(entry["u"]), (now - entry["t"]) > CACHE_TIMEOUT)
+
+
+def get_vrc_user_from_cache(user_id: str) -> Tuple[Union[dict, None], bool]:
+    """
+    Get information about a VRChat user from the cache.
 
-    If the information is present in the cache, query it instead.
+    Recently used entries are kept in an in-process cache for a few seconds;
+    otherwise, this only performs a Redis lookup, so it is cheap enough to call
+    directly from the event loop. User data is returned read-only.
 
     :returns: Tuple with two items:
-      - Dictionary with user data if the user was found, None otherwise.
-      - Boolean representing cache hit; True if response was cached, False otherwise.
+      - Dictionary with user data if the user was cached, an empty dictionary if
+        the user was cached as not found, None otherwise.
+      - Boolean which is True if the data is older than CACHE_TIMEOUT and should
+        be refreshed.
+    """
+    entry = _local_get(user_id)
+    if entry is None:
+        entry = cache.get_json(get_user_cache_key(user_id), shared=True)
+        if entry is not None:
+            _local_set(user_id, entry)
+    return _unpack_cached_user(entry)
+
+
+def get_vrc_user_raw(user_id: str) -> Union[bytes, None]:
     """
-    cache_key = f"vrcembed:users:{user_id}"
-    user = cache.get_json(cache_key)
-    user_cached = True
+    Get the cache entry for a VRChat user as stored in Redis, without decoding it.
 
-    if not user:
-        user_cached = False
-        user_api = users_api.UsersApi(vrc_api)
+    Useful for passing cached data along as JSON without decoding and
+    re-encoding it. The entry is a JSON object with the fetch timestamp under
+    "t" and the user data under "u", or {"__nf__": 1} for users cached as not
+    found.
+
+    :returns: JSON-encoded cache entry, or None if the user is not cached.
+    """
+    return cache.get_bin(get_user_cache_key(user_id))
+
+
+def get_vrc_users_from_cache(
+    user_ids: Iterable[str],
+) -> dict[str, Tuple[Union[dict, None], bool]]:
+    """
+    Get information about multiple VRChat users from the cache, in one request.
 
+    User data is returned read-only, as in get_vrc_user_from_cache.
+
+    :returns: Dictionary mapping each user ID to a tuple with the same two items
+        as returned by get_vrc_user_from_cache.
+    """
+    user_ids = list(user_ids)
+    cached = cache.get_many_json(
+        (get_user_cache_key(user_id) for user_id in user_ids), shared=True
+    )
+
+    now = time.time()
+    return dict(
+        (user_id, _unpack_cached_user(cached[get_user_cache_key(user_id)], now))
+        for user_id in user_ids
+    )
+
+
+def _acquire_user_fetch_lock(user_id: str) -> bool:
+    """
+    Try to acquire the lock for fetching the user with the given ID from the API.
+
+    :returns: True if the lock was acquired, False if another request holds it.
+    """
+    return cache.set_nx(
+        f"vrcembed:lock:{{{user_id}}}", "1", timeout=USER_FETCH_LOCK_TIMEOUT
+    )
+
+
+def _get_fresh_user_from_redis(user_id: str) -> Union[dict, None]:
+    """
+    Get user data from Redis if it is not stale, bypassing the in-process cache.
+
+    Fresh data is also stored in the in-process cache, replacing the stale copy
+    that caused the lookup.
+
+    :returns: Same as the first item returned by get_vrc_user_from_cache, except
+        that stale data is returned as None.
+    """
+    entry = cache.get_json(get_user_cache_key(user_id), shared=True)
+    user, stale = _unpack_cached_user(entry)
+    if user is None or stale:
+        return None
+    _local_set(user_id, entry)
+    return user
+
+
+def get_vrc_user_from_api(user_id: str) -> Union[dict, None]:
+    """
+    Fetch information about a VRChat user from the VRChat API and cache it.
+
+    If another request is already fetching the same user, waits for it to
+    finish instead, for up to USER_FETCH_WAIT_TIMEOUT seconds.
+
+    :returns: Dictionary with user data if the user was found, None otherwise.
+    """
+    if not _acquire_user_fetch_lock(user_id):
+        deadline = time.monotonic() + USER_FETCH_WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(USER_FETCH_POLL_INTERVAL)
+            user = _get_fresh_user_from_redis(user_id)
+            if user is not None:
+                return user or None
+
+    try:
         try:
             _user = user_api.get_user(user_id)
         except vrchatapi.exceptions.UnauthorizedException:
             api_log_in()
             _user = user_api.get_user(user_id)
-        except vrchatapi.exceptions.NotFoundException:
-            user = None
-            cache.set(cache_key, "{}", timeout=CACHE_TIMEOUT)
+    except vrchatapi.exceptions.NotFoundException:
+        cache_user_not_found(user_id)
+        return None
+
+    user = serialize_user(_user)
+    cache_user(user_id, user)
+    return user
+
+
+def get_vrc_user(user_id: str) -> Tuple[Union[dict, None], bool]:
+    """
+    Fetch information about a VRChat user by their user ID.
+
+    If the information is present in the cache, query it instead; cached user
+    data is returned read-only.
+
+    :returns: Tuple with two items:
+      - Dictionary with user data if the user was found, None otherwise.
+      - Boolean representing cache hit; True if response was cached, False otherwise.
+    """
+    user, stale = get_vrc_user_from_cache(user_id)
+    if user is not None and not stale:
+        return (user or None, True)
+    return (get_vrc_user_from_api(user_id), False)
+
+
+def get_vrc_users(user_ids: Iterable[str]) -> dict[str, Union[dict, None]]:
+    """
+    Fetch information about multiple VRChat users by their user IDs.
+
+    Cached users are looked up in a single request; users missing from the
+    cache or stale are fetched from the API in parallel. Cached user data is
+    returned read-only.
+
+    :returns: Dictionary mapping each user ID to a dictionary with user data if
+        the user was found, or None otherwise.
+    """
+    cached = get_vrc_users_from_cache(dict.fromkeys(user_ids))
+
+    out = {}
+    missing = []
+    for user_id, (user, stale) in cached.items():
+        if user is None or stale:
+            missing.append(user_id)
         else:
-            user = serialize_user(_user)
-            cache.set_json(cache_key, user, timeout=CACHE_TIMEOUT)
+            out[user_id] = user or None
+
+    if missing:
+        out.update(
+            zip(missing, _user_fetch_executor.map(get_vrc_user_from_api, missing))
+        )
+
+    return out
+
+
+def _api_cookie_header() -> str:
+    """Get the Cookie header value for the current VRChat API login cookies."""
+    return "; ".join(f"{c.name}={c.value}" for c in vrc_api.rest_client.cookie_jar)
+
+
+async def _api_get_user_async(user_id: str) -> httpx.Response:
+    """Send a request for the user with the given ID to the VRChat API."""
+    # The user ID comes from the request URL, so it must not be able to change
+    # the API path or add query parameters
+    return await vrc_http.get(
+        f"/users/{quote(user_id, safe='')}", headers={"Cookie": _api_cookie_header()}
+    )
+
+
+async def get_vrc_user_from_api_async(user_id: str) -> Union[dict, None]:
+    """
+    Fetch information about a VRChat user from the VRChat API and cache it.
+
+    Async version of get_vrc_user_from_api, which performs the API request on
+    the event loop instead of blocking a thread.
+
+    :returns: Dictionary with user data if the user was found, None otherwise.
+    """
+    # Dot segments would be normalized away by httpx even when quoted, turning
+    # the request into one for a different API path
+    if user_id in ("", ".", ".."):
+        return None
+
+    if not _acquire_user_fetch_lock(user_id):
+        deadline = time.monotonic() + USER_FETCH_WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(USER_FETCH_POLL_INTERVAL)
+            user = _get_fresh_user_from_redis(user_id)
+            if user is not None:
+                return user or None
+
+    response = await _api_get_user_async(user_id)
+    if response.status_code == 401:
+        await asyncio.to_thread(api_log_in)
+        response = await _api_get_user_async(user_id)
+
+    if response.status_code == 404:
+        cache_user_not_found(user_id)
+        return None
+
+    response.raise_for_status()
+
+    user = serialize_user_json(response.json())
+    cache_user(user_id, user)
+    return user
+
+
+async def get_vrc_user_async(user_id: str) -> Tuple[Union[dict, None], bool]:
+    """
+    Fetch information about a VRChat user by their user ID.
+
+    Async version of get_vrc_user. Cache hits are served directly on the event
+    loop, without a thread hop, and are returned read-only.
+
+    :returns: Tuple with two items:
+      - Dictionary with user data if the user was found, None otherwise.
+      - Boolean representing cache hit; True if response was cached, False otherwise.
+    """
+    user, stale = get_vrc_user_from_cache(user_id)
+    if user is not None:
+        if stale:
+            _refresh_user_in_background(user_id)
+        return (user or None, True)
+    return (await get_vrc_user_from_api_async(user_id), False)
+
+
+#: Background tasks refreshing stale cached users, by user ID.
+_refresh_tasks = {}
+
+
+def _refresh_user_in_background(user_id: str):
+    """Start a background task to refresh the cached data for the given user."""
+    if user_id in _refresh_tasks:
+        return
+
+    def _done(task: asyncio.Task):
+        del _refresh_tasks[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error refreshing user {user_id}: {task.exception()}")
 
-    return (user, user_cached)
+    task = asyncio.create_task(get_vrc_user_from_api_async(user_id))
+    _refresh_tasks[user_id] = task
+    task.add_done_callback(_done)
 
 
 def accept_friend_requests():